@@ -3,10 +3,13 @@
 # Streamlit app for ABCIE shift scheduling
 # How to run: streamlit run streamlit_shift_app.py
 import sqlite3
+import numpy as np
+import openpyxl
 import pandas as pd
 from datetime import datetime, timedelta
 import streamlit as st
 from io import BytesIO
+from scipy.optimize import linear_sum_assignment
 
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -31,15 +34,25 @@ st.title("排班系統")
 st.set_page_config(page_title="ABCIE Shift Scheduler", layout="wide")
 
 ZONES = ["A", "B", "C", "I", "E"]
+ZONE_INDEX = {z: i for i, z in enumerate(ZONES)}
+EMPLOYEE_COLUMNS = ["name", "points", "max_points", "off_days", "preferred_zone", "allowed_zones"]
 
 # ---------- Database Utilities ----------
 @st.cache_resource
 def get_conn(db_path="shift_schedule.db"):
     conn = sqlite3.connect(db_path, check_same_thread=False)
+    # single local user: WAL + NORMAL sync avoids a full fsync on every commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
     return conn
 
 def setup_database(conn):
     cursor = conn.cursor()
+    # one explicit transaction for the schema checks instead of autocommitting each statement
+    if not conn.in_transaction:
+        cursor.execute("BEGIN")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS employees (
             name TEXT PRIMARY KEY,
@@ -63,108 +76,167 @@ def setup_database(conn):
 
 def add_or_update_employee(conn, name, initial_points=0, max_points=10,
                            off_days=None, preferred_zone=None, allowed_zones=None):
-    if off_days is None:
-        off_days = []
-    if allowed_zones is None:
-        allowed_zones = []
-    off_days_str = ",".join(off_days)
-    allowed_str = ",".join(allowed_zones)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR IGNORE INTO employees (name, points, max_points, off_days, preferred_zone, allowed_zones)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (name, initial_points, max_points, off_days_str, preferred_zone, allowed_str))
-    cursor.execute("""
-        UPDATE employees
-           SET max_points = ?,
-               off_days = ?,
-               preferred_zone = ?,
-               allowed_zones = ?
-         WHERE name = ?
-    """, (max_points, off_days_str, preferred_zone, allowed_str, name))
-    conn.commit()
+    bulk_add_or_update_employees(conn, [(name, initial_points, max_points,
+                                         off_days, preferred_zone, allowed_zones)])
+
+def bulk_add_or_update_employees(conn, rows):
+    """
+    rows: (name, initial_points, max_points, off_days, preferred_zone, allowed_zones) tuples.
+    New employees start at initial_points; existing ones keep their points.
+    """
+    params = [
+        (name, initial_points, max_points, ",".join(off_days or []),
+         preferred_zone, ",".join(allowed_zones or []))
+        for name, initial_points, max_points, off_days, preferred_zone, allowed_zones in rows
+    ]
+    with conn:
+        conn.executemany("""
+            INSERT INTO employees (name, points, max_points, off_days, preferred_zone, allowed_zones)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                max_points = excluded.max_points,
+                off_days = excluded.off_days,
+                preferred_zone = excluded.preferred_zone,
+                allowed_zones = excluded.allowed_zones
+        """, params)
+    _invalidate_employee_cache()
 
 def get_employees(conn):
-    df = pd.read_sql_query("SELECT * FROM employees", conn)
-    if df.empty:
-        return df
-    df["off_days"] = df["off_days"].apply(lambda x: x.split(",") if x else [])
-    df["allowed_zones"] = df["allowed_zones"].apply(lambda x: [s for s in (x.split(",") if x else []) if s])
-    return df
-
-def update_points(conn, name, points):
+    """Return employee rows as tuples ordered like EMPLOYEE_COLUMNS."""
+    rows = conn.execute(
+        "SELECT name, points, max_points, off_days, preferred_zone, allowed_zones FROM employees"
+    ).fetchall()
+    return [
+        (name, pts, mx, frozenset(off.split(",")) if off else frozenset(), pref,
+         [z for z in (al.split(",") if al else []) if z])
+        for name, pts, mx, off, pref, al in rows
+    ]
+
+def get_employee_points(conn):
+    return pd.read_sql_query("SELECT name, points, max_points FROM employees ORDER BY name", conn)
+
+# Both loaders are shared by every session; writers clear them via _invalidate_employee_cache
+@st.cache_data
+def _load_employees():
+    return get_employees(get_conn())
+
+@st.cache_data
+def _load_employee_points():
+    return get_employee_points(get_conn())
+
+def _invalidate_employee_cache():
+    _load_employees.clear()
+    _load_employee_points.clear()
+
+def update_points(conn, deltas):
+    """Add each {name: points} delta to the stored points in one transaction."""
     cursor = conn.cursor()
-    cursor.execute("UPDATE employees SET points = points + ? WHERE name = ?", (points, name))
+    cursor.executemany("UPDATE employees SET points = points + ? WHERE name = ?",
+                       [(points, name) for name, points in deltas.items()])
     conn.commit()
-
-def is_weekend(date_str):
-    return datetime.strptime(date_str, "%Y-%m-%d").weekday() >= 5
+    _invalidate_employee_cache()
 
 def generate_schedule(conn, start_date, end_date, apply_points=True):
     """
     5 zones (A,B,C,I,E) each need 1 person per day.
-    Priority: preferred_zone match (True>False) → fewer current points → name
+    Each day is solved as a min-cost matching between zones and employees, so
+    as many zones as possible are filled.
+    Priority: preferred_zone match (True>False) → fewer current points → name → zone order
+    Preferences apply across the whole day: when not every zone can be filled, an employee
+    still goes to their preferred zone even if an earlier zone stays empty; only on equal
+    cost do earlier zones in ZONES win.
     Constraints: not on off_days; at most one shift within 3 days; not exceed max_points; zone in allowed_zones; not 2 shifts in the same day.
+    Returns (schedule_df, unassigned_df, points_delta, employee_names) where points_delta maps
+    name → points earned and employee_names are the employees the schedule was built from,
+    in table order.
     """
     schedule = []
     unassigned = []
-    assigned_last = {}
     # snapshot employees (points may change if apply_points=True)
-    current = datetime.strptime(start_date, "%Y-%m-%d")
-    end     = datetime.strptime(end_date,   "%Y-%m-%d")
-
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end   = datetime.strptime(end_date,   "%Y-%m-%d")
+    # (date_str, point_value) per day; weekends are worth 2 points
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    day_info = [(d.strftime("%Y-%m-%d"), 2 if d.weekday() >= 5 else 1) for d in days]
+
+    # Parse the employee table once into per-attribute arrays (column j is
+    # employee j); only points change during generation. Sorting by name makes
+    # the column index double as the name tie-break in the cost matrix.
+    fetched = get_employees(conn)
+    employee_names = [row[0] for row in fetched]
+    rows = sorted(fetched, key=lambda row: row[0])
+    names = [row[0] for row in rows]
     # We'll track in-memory point tallies to make fair decisions even if not applying to DB yet
-    base_df = get_employees(conn).copy()
-    points_map = {r["name"]: int(r["points"]) if pd.notna(r["points"]) else 0 for _, r in base_df.iterrows()}
-
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
-        point_value = 2 if is_weekend(date_str) else 1
-        assigned_today = set()
-        for zone in ZONES:
-            df = get_employees(conn)
-            if df.empty:
-                unassigned.append({"Date": date_str, "Zone": zone, "Reason": "No employees"})
-                continue
-            candidates = []
-            for _, r in df.iterrows():
-                name = r["name"]
-                points = points_map.get(name, 0)
-                max_points = int(r["max_points"]) if pd.notna(r["max_points"]) else 0
-                off_days = r["off_days"] or []
-                allowed = set(r["allowed_zones"] or [])
-                preferred = (r.get("preferred_zone") or "").strip()
-                last = assigned_last.get(name)
-                days_since_last = (current - last).days if last else 9999
-                if (
-                    date_str not in off_days and
-                    name not in assigned_today and
-                    days_since_last >= 3 and
-                    (points + point_value) <= max_points and
-                    zone in allowed
-                ):
-                    pref_match = (preferred == zone)
-                    candidates.append((pref_match, points, name))
-            candidates.sort(key=lambda t: (-int(t[0]), t[1], t[2]))
-            if candidates:
-                _, _, chosen = candidates[0]
-                schedule.append({
-                    "Date": date_str,
-                    "Shift": zone,
-                    "Employee": chosen,
-                    "Points": point_value
-                })
-                assigned_last[chosen] = current
-                assigned_today.add(chosen)
-                # Update in-memory points and optionally DB
-                points_map[chosen] = points_map.get(chosen, 0) + point_value
-                if apply_points:
-                    update_points(conn, chosen, point_value)
+    points = np.array([int(row[1] or 0) for row in rows], dtype=np.int64)
+    max_pts = np.array([int(row[2] or 0) for row in rows], dtype=np.int64)
+    # zone index of the preferred zone, -1 for none
+    pref_zone = np.array([ZONE_INDEX.get((row[4] or "").strip(), -1) for row in rows], dtype=np.int8)
+    # bit z set if ZONES[z] is allowed
+    allowed_bits = np.array([sum(1 << ZONE_INDEX[z] for z in set(row[5]) if z in ZONE_INDEX)
+                             for row in rows], dtype=np.uint8)
+    # off_mask[d, j]: day d is one of employee j's off days (day-major so each day is one row)
+    day_to_idx = {date_str: d for d, (date_str, _) in enumerate(day_info)}
+    off_mask = np.zeros((len(day_info), len(rows)), dtype=bool)
+    for j, row in enumerate(rows):
+        for off in row[3]:
+            d = day_to_idx.get(off)
+            if d is not None:
+                off_mask[d, j] = True
+    # day index of each employee's last shift; far in the past until assigned
+    last_day = np.full(len(rows), -10000, dtype=np.int32)
+    points_delta = {}
+
+    # Cost weights: a preference miss outweighs any points difference, points
+    # outweigh the name tie-break, the name outweighs the zone-order tie-break
+    # (zone index, weight 1), and blocked pairs outweigh everything so the
+    # matching always fills as many zones as it can.
+    num_zones, num_employees = len(ZONES), len(rows)
+    max_cap = int(max_pts.max(initial=0))
+    name_weight = num_zones * num_zones
+    points_weight = num_zones * num_employees * name_weight
+    pref_weight = num_zones * points_weight * (max_cap + 1)
+    blocked = 2 * num_zones * pref_weight
+    name_rank = np.arange(num_employees, dtype=np.int64)
+    # ZONES is fixed, so the allowed-zone bits and preference/zone-order costs are
+    # expanded once into (zone, employee) tables rather than every day.
+    zone_ids = np.arange(num_zones)[:, None]
+    zone_allowed = ((allowed_bits >> zone_ids) & 1).astype(bool)
+    zone_pref_cost = (pref_zone != zone_ids) * pref_weight + zone_ids
+
+    for day_idx, (date_str, point_value) in enumerate(day_info):
+        if not num_employees:
+            for zone in ZONES:
+                unassigned.append((date_str, zone, "No employees"))
+            continue
+        # zone-independent constraints: off day, 3-day gap, max_points
+        available = ~off_mask[day_idx]
+        available &= (day_idx - last_day) >= 3
+        available &= (points + point_value) <= max_pts
+        # (zone, employee) eligibility and cost for the whole day in one broadcast
+        eligible = available & zone_allowed
+        cost = np.where(eligible, zone_pref_cost + points * points_weight + name_rank * name_weight,
+                        blocked)
+        # one employee per zone and at most one zone per employee
+        row_ind, col_ind = linear_sum_assignment(cost)
+        matched = dict(zip(row_ind.tolist(), col_ind.tolist()))
+        for i, zone in enumerate(ZONES):
+            j = matched.get(i)
+            if j is not None and cost[i, j] < blocked:
+                chosen = names[j]
+                schedule.append((date_str, zone, chosen, point_value))
+                last_day[j] = day_idx
+                # Update in-memory points; the DB is written once after the loop
+                points[j] += point_value
+                points_delta[chosen] = points_delta.get(chosen, 0) + point_value
             else:
-                unassigned.append({"Date": date_str, "Zone": zone, "Reason": "No eligible employees"})
-        current += timedelta(days=1)
+                unassigned.append((date_str, zone, "No eligible employees"))
+
+    if apply_points and points_delta:
+        update_points(conn, points_delta)
 
-    return pd.DataFrame(schedule), pd.DataFrame(unassigned)
+    return (pd.DataFrame(schedule, columns=["Date", "Shift", "Employee", "Points"]),
+            pd.DataFrame(unassigned, columns=["Date", "Zone", "Reason"]),
+            points_delta, employee_names)
 
 def reset_points(conn, names=None):
     cursor = conn.cursor()
@@ -174,6 +246,7 @@ def reset_points(conn, names=None):
         placeholders = ",".join("?" for _ in names)
         cursor.execute(f"UPDATE employees SET points = 0 WHERE name IN ({placeholders})", names)
     conn.commit()
+    _invalidate_employee_cache()
 
 def delete_employees(conn, names):
     if isinstance(names, str):
@@ -185,38 +258,45 @@ def delete_employees(conn, names):
     cursor.execute(f"DELETE FROM employees WHERE name IN ({placeholders})", names)
     deleted = cursor.rowcount or 0
     conn.commit()
+    _invalidate_employee_cache()
     return deleted
 
-def export_schedule_as_matrix(schedule_df, employees_df, start_date, end_date):
+def export_schedule_as_matrix(schedule_df, employee_names, start_date, end_date, points_delta):
     start = datetime.strptime(start_date, "%Y-%m-%d")
     end   = datetime.strptime(end_date,   "%Y-%m-%d")
     dates = [(start + timedelta(days=i)).strftime("%Y-%m-%d")
              for i in range((end - start).days + 1)]
-    if not employees_df.empty:
-        employees = employees_df["name"].tolist()
+    if employee_names:
+        employees = list(employee_names)
     else:
         employees = sorted(schedule_df["Employee"].unique().tolist())
-    mat = pd.DataFrame("", index=dates, columns=employees)
-    for _, r in schedule_df.iterrows():
-        d = str(r["Date"]); e = str(r["Employee"]); s = str(r["Shift"])
-        if d in mat.index and e in mat.columns:
-            cur = mat.at[d, e]
-            if cur == "":
-                mat.at[d, e] = s
-            elif s not in cur:
-                mat.at[d, e] = f"{cur}/{s}"
-    # Add points row based on current schedule_df, not DB
-    point_sum = schedule_df.groupby("Employee")["Points"].sum() if not schedule_df.empty else pd.Series(dtype=int)
-    mat.loc["Points"] = 0
-    for emp in employees:
-        mat.at["Points", emp] = int(point_sum.get(emp, 0))
-    # Return as Excel bytes
+    date_to_i = {d: i for i, d in enumerate(dates)}
+    emp_to_j = {e: j for j, e in enumerate(employees)}
+    # dates x employees grid of shift labels; None leaves the cell blank
+    mat = np.full((len(dates), len(employees)), None, dtype=object)
+    if not schedule_df.empty:
+        for d, e, s in zip(schedule_df["Date"].tolist(), schedule_df["Employee"].tolist(),
+                           schedule_df["Shift"].tolist()):
+            i, j = date_to_i.get(d), emp_to_j.get(e)
+            if i is None or j is None:
+                continue
+            mat[i, j] = s if mat[i, j] is None else f"{mat[i, j]}/{s}"
+    # Add points row from the points generate_schedule handed out, not DB
+    point_row = [int(points_delta.get(emp, 0)) for emp in employees]
+    # Return as Excel bytes; rows are streamed straight into a write-only workbook
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Matrix")
+    ws.freeze_panes = "B2"
+    ws.append([None, *employees])
+    for d, cells in zip(dates, mat.tolist()):
+        ws.append([d, *cells])
+    ws.append(["Points", *point_row])
+    ws = wb.create_sheet("Schedule_Long")
+    ws.append(schedule_df.columns.tolist())
+    for row in schedule_df.itertuples(index=False, name=None):
+        ws.append(row)
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        mat.to_excel(writer, sheet_name="Matrix")
-        schedule_df.to_excel(writer, sheet_name="Schedule_Long", index=False)
-        ws = writer.book["Matrix"]
-        ws.freeze_panes = "B2"
+    wb.save(output)
     output.seek(0)
     return output
 
@@ -269,7 +349,8 @@ with st.sidebar:
                 st.error("Please enter at least one name.")
 
 st.subheader("👥 Employees")
-emp_df = get_employees(conn)
+emp_df = pd.DataFrame(_load_employees(), columns=EMPLOYEE_COLUMNS)
+emp_df["off_days"] = emp_df["off_days"].map(sorted)
 st.dataframe(emp_df)
 
 with st.expander("📦 Seed demo employees", expanded=False):
@@ -293,13 +374,11 @@ with st.expander("📦 Seed demo employees", expanded=False):
             {"name": "R5-B", "initial": 0, "max": 5, "off": [], "pref": "E", "allow": ["A", "B", "C", "I", "E"]},
             {"name": "R5-C", "initial": 0, "max": 5, "off": [], "pref": "", "allow": ["A", "B", "C", "I", "E"]},
         ]
-        for emp in demo_employees:
-            add_or_update_employee(
-                conn,
-                emp["name"], emp["initial"], emp["max"], emp["off"],
-                preferred_zone=emp["pref"] if emp["pref"] else None,
-                allowed_zones=emp["allow"]
-            )
+        bulk_add_or_update_employees(conn, [
+            (emp["name"], emp["initial"], emp["max"], emp["off"],
+             emp["pref"] if emp["pref"] else None, emp["allow"])
+            for emp in demo_employees
+        ])
         st.success("Demo employees inserted. Refresh the Employees table if needed.")
 
 st.divider()
@@ -318,9 +397,9 @@ if st.button("Generate"):
     if start_date > end_date:
         st.error("Start date must be on or before end date.")
     else:
-        df_schedule, unassigned = generate_schedule(conn, start_date.strftime("%Y-%m-%d"),
-                                                    end_date.strftime("%Y-%m-%d"),
-                                                    apply_points=apply_points)
+        df_schedule, unassigned, points_delta, employee_names = generate_schedule(
+            conn, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+            apply_points=apply_points)
         st.success("Schedule generated.")
         st.write("### 排班表（長表）")
         st.dataframe(df_schedule)
@@ -329,10 +408,10 @@ if st.button("Generate"):
 
         # Export section
         st.write("### 匯出 Excel")
-        employees_df = get_employees(conn)
-        excel_data = export_schedule_as_matrix(df_schedule, employees_df,
+        excel_data = export_schedule_as_matrix(df_schedule, employee_names,
                                                start_date.strftime("%Y-%m-%d"),
-                                               end_date.strftime("%Y-%m-%d"))
+                                               end_date.strftime("%Y-%m-%d"),
+                                               points_delta)
         st.download_button(
             label="Download ABCIE_shift_matrix.xlsx",
             data=excel_data,
@@ -342,7 +421,7 @@ if st.button("Generate"):
 
 st.divider()
 st.subheader("📊 Current Points & Limits")
-pts_df = get_employees(conn)[["name", "points", "max_points"]].sort_values("name")
+pts_df = _load_employee_points()
 st.dataframe(pts_df)
 
 st.caption("© ABCIE Scheduler – Streamlit adaptation")